@@ -23,16 +23,21 @@
 # SOFTWARE.
 
 import argparse
-import codecs
+import ast
+import csv
+import fcntl
+import io
 import json
+import os
+import select
 import sys
 import threading
-from queue import Queue, Empty
-import time
+from queue import Queue
 from typing import BinaryIO
 
 import ffmpeg
 import klvdata
+from klvdata.setparser import SetParser
 
 
 def detect_klv_stream_index(stream_url):
@@ -51,142 +56,216 @@ def detect_klv_stream_index(stream_url):
     return None
 
 
-class KlvPacketReader(threading.Thread):
+def _next_klv_packet(buf, pos, buf_length, sync, header_size):
+    """Locate the next complete KLV packet in buf at or after pos.
+
+    Returns (start, end, next_pos): the slice bounds of the packet and the
+    cursor to resume scanning from. start is -1 when no complete packet is
+    buffered yet; next_pos then marks where scanning should restart once
+    more data has been read.
+    """
+    start = buf.find(sync, pos)
+    if start < 0:
+        # No sync pattern; keep only a tail short enough to hold a partial
+        # one split across chunks.
+        return -1, -1, max(pos, buf_length - len(sync) + 1)
+    # Decode the BER-encoded length following the header:
+    ber_pos = start + header_size
+    if ber_pos >= buf_length:
+        return -1, -1, start
+    byte_length = buf[ber_pos]
+    if byte_length < 128:
+        length = byte_length
+        value_pos = ber_pos + 1
+    else:
+        value_pos = ber_pos + 1 + (byte_length - 128)
+        if value_pos > buf_length:
+            return -1, -1, start
+        length = int.from_bytes(buf[ber_pos + 1 : value_pos], "big")
+    end = value_pos + length
+    if end > buf_length:
+        # Packet not fully buffered yet; wait for more data.
+        return -1, -1, start
+    return start, end, end
+
+
+class KlvPacketReader:
+    """Frames KLV packets from a byte stream.
+
+    packets() is a generator driven on the calling thread: with only a
+    single producer (the ffmpeg pipe) there is nothing to gain from a
+    dedicated reader thread, so data is awaited with select instead. The
+    caller decides where the framed packets go.
+    """
 
     def __init__(
         self,
         src: BinaryIO,
-        output_queue: Queue,
         klv_header_size=16,
         klv_sync_pattern=b"\x06\x0e+4",
+        read_size=1024 * 1024,
     ):
-        super().__init__(name="KlvPacketReader")
         self._src = src
-        self._output_queue = output_queue
         self._klv_sync_pattern = klv_sync_pattern
         self._klv_header_size = klv_header_size
+        self._read_size = read_size
         self._stopped = threading.Event()
+        # On Linux, grow the kernel pipe buffer to match the read size so
+        # ffmpeg can keep writing between our reads. Best effort only; the
+        # default pipe size is kept wherever this is unsupported.
+        try:
+            fcntl.fcntl(src.fileno(), fcntl.F_SETPIPE_SZ, read_size)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            pass
 
     def stop(self):
         self._stopped.set()
 
-    def _read(self, src: BinaryIO, num_bytes, buffer):
-
-        data = src.read(num_bytes)
-
-        return data, buffer + data
-
-    def _read_value(self, src, num_bytes, buffer):
+    def packets(self):
+        """Yield complete KLV packets as they are framed from the source."""
 
-        data = src.read(num_bytes)
-
-        return ord(data), buffer + data
-
-    def _read_ber(self, src, buffer):
-
-        byte_length, buffer = self._read_value(src, 1, buffer)  # reads BER byte
-
-        if byte_length < 128:
-            length = byte_length
+        sync = self._klv_sync_pattern
+        header_size = self._klv_header_size
+        read_size = self._read_size
+        # Bind the Event method once; a plain bool would never see stop().
+        stopped = self._stopped.is_set
+        src = self._src
+        try:
+            fd = src.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            fd = None
+        if fd is not None:
+            # Read the raw descriptor directly, skipping the BufferedReader
+            # layer and its intermediate copy. Nothing else has read from
+            # src at this point, so its buffer holds no stray bytes.
+            def read(num_bytes, fd=fd):
+                return os.read(fd, num_bytes)
         else:
-            length, buffer = self._read_value(src, byte_length - 128, buffer)
-
-        _, buffer = self._read(src, length, buffer)
+            # read1 returns whatever a single underlying read yields
+            # instead of blocking until read_size bytes have accumulated.
+            read = getattr(src, "read1", src.read)
+
+        # Persistent accumulator: large reads go in, complete packets come out.
+        buf = bytearray()
+
+        while not stopped():
+            if fd is not None:
+                # Wait for data; the timeout keeps stop() responsive.
+                ready, _, _ = select.select([fd], [], [], 1.0)
+                if not ready:
+                    continue
+            chunk = read(read_size)
+            if not chunk:
+                break
+            buf += chunk
+
+            pos = 0
+            buf_length = len(buf)
+            with memoryview(buf) as view:
+                while True:
+                    start, end, pos = _next_klv_packet(
+                        buf, pos, buf_length, sync, header_size
+                    )
+                    if start < 0:
+                        break
+                    # Hand over the complete packet (single copy):
+                    yield bytes(view[start:end])
+            # Discard consumed bytes:
+            if pos:
+                del buf[:pos]
 
-        return buffer
 
-    def run(self):
-
-        klv_sync_pattern_length = len(self._klv_sync_pattern)
-        klv_header_excl_sync = self._klv_header_size - klv_sync_pattern_length
-
-        while not self._stopped.is_set():
-            # Init empty buffer:
-            buffer = b""
-
-            # Read sync pattern:
-            header, buffer = self._read(self._src, klv_sync_pattern_length, buffer)
-
-            if header == self._klv_sync_pattern:
-                # Read rest of the header:
-                _, buffer = self._read(self._src, klv_header_excl_sync, buffer)
-                # Read BER-encoded data:
-                buffer = self._read_ber(self._src, buffer)
-                # Place data into the queue:
-                self._output_queue.put(buffer)
+class KlvOutputWriter:
+    """Formats KLV metadata for output.
 
+    Every method returns the text to emit; the printer batches the strings
+    for a whole packet and writes them out in one call.
+    """
 
-class KlvOutputWriter:
+    def start(self):
+        return ""
 
-    def start(self, out: BinaryIO):
-        pass
-    
-    def start_entry(self, out: BinaryIO, entry_index):
-        pass
+    def start_entry(self, entry_index):
+        return ""
 
-    def write_item(self, out: BinaryIO, tag, item, entry_index, item_index):
-        pass
+    def format_item(self, tag, item, entry_index, item_index):
+        return ""
 
-    def end_entry(self, out: BinaryIO, entry_index):
-        pass
+    def end_entry(self, entry_index):
+        return ""
 
-    def end(self, out: BinaryIO):
-        pass
+    def end(self):
+        return ""
 
 
 class KlvTextOutputWriter(KlvOutputWriter):
 
-    def start_entry(self, out: BinaryIO, entry_index):
-        out.write(f"> KLV Packet #{entry_index}\n")
+    def start_entry(self, entry_index):
+        return f"> KLV Packet #{entry_index}\n"
 
-    def write_item(self, out: BinaryIO, tag, item, entry_index, item_index):
+    def format_item(self, tag, item, entry_index, item_index):
         LDSName, ESDName, UDSName, value = item
-        out.write(f"\t [{tag}] {LDSName}: {value}\n")
+        return f"\t [{tag}] {LDSName}: {value}\n"
 
 
 class KlvCsvOutputWriter(KlvOutputWriter):
 
-    def start(self, out):
-        out.write(f"#,tag,field,value\n")
+    def __init__(self):
+        # A single csv.writer is shared across all rows; it writes into an
+        # internal buffer that is drained per formatted row.
+        self._row_buffer = io.StringIO()
+        self._csv_writer = csv.writer(self._row_buffer, lineterminator="\n")
 
-    def write_item(self, out: BinaryIO, tag, item, entry_index, item_index):
+    def start(self):
+        return "#,tag,field,value\n"
+
+    def format_item(self, tag, item, entry_index, item_index):
         LDSName, ESDName, UDSName, value = item
-        out.write(f"{entry_index},{tag},{LDSName},{value}\n")
+        self._csv_writer.writerow((entry_index, tag, LDSName, value))
+        row = self._row_buffer.getvalue()
+        self._row_buffer.seek(0)
+        self._row_buffer.truncate()
+        return row
 
 
 class KlvJsonOutputWriter(KlvOutputWriter):
 
-    def start(self, out):
-        out.write("[\n")
+    def __init__(self):
+        # Items are collected as plain Python objects per packet and
+        # serialized with a single json.dumps call in end_entry.
+        self._items = []
 
-    def end(self, out):
-        out.write("]\n")
-        out.flush()
+    def start(self):
+        return "[\n"
 
-    def start_entry(self, out, entry_index):
-        if entry_index > 1:
-            out.write(',\n')
-        out.write('\t{\n\t\t"items": [\n')
+    def end(self):
+        return "]\n"
 
-    def _to_hex_str(self, value):
-        if len(value) < 3:
-            return ""
-        input_str = value[2:-1]
-        byte_data = codecs.decode(input_str, 'unicode_escape').encode('latin1')
-        return f'"{"".join(f"{byte:02x}" for byte in byte_data)}"'
+    def start_entry(self, entry_index):
+        self._items = []
+        return ',\n' if entry_index > 1 else ''
 
-    def write_item(self, out: BinaryIO, tag, item, entry_index, item_index):
+    def _to_hex(self, value):
+        # value is the repr of a bytes object (e.g. "b'\\x0b\\x12'").
+        try:
+            byte_data = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            byte_data = b""
+        if not isinstance(byte_data, bytes):
+            byte_data = b""
+        return byte_data.hex()
+
+    def format_item(self, tag, item, entry_index, item_index):
         LDSName, ESDName, UDSName, value = item
-        if item_index > 1:
-            out.write(", \n")
-        out.write(f'\t\t\t{{\n')
-        out.write(f'\t\t\t\t"tag": {json.dumps(tag)},\n')
-        out.write(f'\t\t\t\t"field": {json.dumps(LDSName)},\n')
-        out.write(f'\t\t\t\t"value": { self._to_hex_str(value) if tag == 1 else json.dumps(value)}\n')
-        out.write(f'\t\t\t}}')
+        self._items.append({
+            "tag": tag,
+            "field": LDSName,
+            "value": self._to_hex(value) if tag == 1 else value,
+        })
+        return ""
 
-    def end_entry(self, out, entry_index):
-        out.write('\n\t\t]\n\t}')
+    def end_entry(self, entry_index):
+        return json.dumps({"items": self._items}, indent="\t")
 
 
 class KlvPrinter(threading.Thread):
@@ -196,33 +275,72 @@ class KlvPrinter(threading.Thread):
         self.input_queue = input_queue
         self.writer = writer
         self.out = out
-        self.stopped = threading.Event()
+        # Maps a 16-byte universal key to the klvdata parser class for it,
+        # so packets with an already-seen key skip StreamParser's generic
+        # key lookup and are parsed straight from their value payload.
+        self._parser_cache = {}
 
     def stop(self):
-        self.stopped.set()
+        # Sentinel: wakes the blocking get() in run() after any queued
+        # packets have been drained.
+        self.input_queue.put(None)
+
+    def _parse_packets(self, buffer):
+        """Parse a framed KLV buffer, reusing cached parsers per key."""
+        parser_class = self._parser_cache.get(buffer[:16])
+        if parser_class is not None:
+            # The reader framed the buffer, so the value payload starts
+            # right after the 16-byte key and the BER-encoded length.
+            byte_length = buffer[16]
+            value_pos = 17 if byte_length < 128 else 17 + (byte_length - 128)
+            return (parser_class(buffer[value_pos:]),)
+        packets = []
+        for packet in klvdata.StreamParser(buffer):
+            packets.append(packet)
+            # Only set parsers take the bare value as their constructor
+            # argument; unknown elements must keep going through klvdata.
+            if isinstance(packet, SetParser):
+                self._parser_cache[bytes(packet.key)] = type(packet)
+        return packets
+
+    def _iter_metadata(self, packet):
+        """Yield (tag, (LDSName, ESDName, UDSName, value)) tuples straight
+        from a parsed packet's elements, nested sets included, without
+        building the intermediate MetadataList() dict per packet."""
+        for element in packet.items.values():
+            try:
+                yield element.TAG, (
+                    element.LDSName,
+                    element.ESDName,
+                    element.UDSName,
+                    str(element.value.value),
+                )
+            except AttributeError:
+                # Unknown elements carry no tag/name metadata; skip them
+                # just as MetadataList() did.
+                pass
+            if hasattr(element, "items"):
+                yield from self._iter_metadata(element)
 
     def run(self) -> None:
         packet_count = 0
-        self.writer.start(self.out)
-        while not self.stopped.is_set():
-            try:
-                buffer = self.input_queue.get(timeout=1.0)
-                for packet in klvdata.StreamParser(buffer):
-                    packet_count += 1
-                    metadata = packet.MetadataList()
-                    self.writer.start_entry(self.out, packet_count)
-                    # print(f"> KLV Packet #{i}")
-                    item_count = 0
-                    for tag, item in metadata.items():
-                        item_count += 1
-                        try:
-                            self.writer.write_item(self.out, tag, item, packet_count, item_count)                            
-                        except KeyError:
-                            pass
-                    self.writer.end_entry(self.out, packet_count)
-            except Empty:
-                continue
-        self.writer.end(self.out)
+        self.out.write(self.writer.start())
+        while True:
+            buffer = self.input_queue.get()
+            if buffer is None:
+                break
+            for packet in self._parse_packets(buffer):
+                packet_count += 1
+                # One writelines per packet instead of a write per item:
+                parts = [self.writer.start_entry(packet_count)]
+                item_count = 0
+                for tag, item in self._iter_metadata(packet):
+                    item_count += 1
+                    parts.append(self.writer.format_item(tag, item, packet_count, item_count))
+                parts.append(self.writer.end_entry(packet_count))
+                self.out.writelines(parts)
+        self.out.write(self.writer.end())
+        self.out.flush()
 
 
 
@@ -260,7 +378,9 @@ if __name__ == "__main__":
         )
         ffmpeg_proc = ffmpeg.run_async(stream, pipe_stdout=True, pipe_stdin=False)
 
-        data_queue = Queue()
+        # Bounded so a slow consumer applies backpressure to the reader
+        # (and through the pipe to ffmpeg) instead of buffering unbounded:
+        data_queue = Queue(maxsize=128)
 
         writer = None
         if args.output == 'json':
@@ -271,21 +391,19 @@ if __name__ == "__main__":
             writer = KlvTextOutputWriter()
 
         klv_printer = KlvPrinter(data_queue, writer, sys.stdout)
-        klv_packet_reader = KlvPacketReader(ffmpeg_proc.stdout, data_queue)
+        klv_packet_reader = KlvPacketReader(ffmpeg_proc.stdout)
 
         klv_printer.start()
-        klv_packet_reader.start()
 
         try:
-            while ffmpeg_proc.poll() is None:
-                time.sleep(1)
+            # Runs on the main thread until EOF on the ffmpeg pipe:
+            for packet in klv_packet_reader.packets():
+                data_queue.put(packet)
         except KeyboardInterrupt:
-            pass
+            klv_packet_reader.stop()
 
-        klv_packet_reader.stop()
         klv_printer.stop()
         ffmpeg_proc.kill()
 
-        klv_packet_reader.join()
         klv_printer.join()
         ffmpeg_proc.wait()